@@ -2,11 +2,18 @@
 
 
 import requests
-import requests_cache
-requests_cache.install_cache('o365', backend='memory')
 from urllib.parse import urlencode as uu
-
-from uuid import uuid4
+from urllib.parse import urlparse
+
+from uuid import uuid4, UUID
+from pathlib import Path
+import tempfile
+import os
+import stat
+import threading
+import random
+import time
+from email.utils import parsedate_to_datetime
 
 from pydantic import BaseModel, Field
 from pydantic import create_model, parse_obj_as
@@ -15,9 +22,10 @@ from pydantic import conint
 
 from typing import List, Dict, Union, Optional, Any, ClassVar
 from enum import Enum
-from datetime import date
+from datetime import date, datetime, timezone
 
 import re
+import json
 from pprint import PrettyPrinter
 pformat = PrettyPrinter(indent=2, compact=False).pformat
 
@@ -331,6 +339,378 @@ class ChangesModel(O365BaseModel):
 
 
 
+##### Fetch Layer ###########################################
+
+class ClientRequestId:
+    """
+        Persistent ClientRequestId. The o365 web service expects one GUID per
+        machine, not one per request, so the GUID is generated once and kept
+        on disk (the same approach as examples/o365.py).
+
+    ATTRIBUTES
+
+        path -> pathlib.Path
+              file holding the GUID between runs.
+
+        value -> str
+              the GUID, loaded (or generated and stored) on first access.
+    """
+    path: Path = Path(tempfile.gettempdir()) / 'o365ipAddr_clientid.txt'
+    _value: str = None
+    _lock = threading.Lock()
+
+    @property
+    def value(self):
+        with self._lock:
+            if self._value is None:
+                self._value = self._load()
+            return self._value
+
+    def _load(self):
+        try:
+            return str(UUID(self.path.read_text().strip()))
+        except (OSError, ValueError):
+            value = str(uuid4())
+            try:
+                self.path.write_text(value + '\n')
+            except OSError as e:
+                debug(f'ClientRequestId: unable to persist {self.path}: {e}\n')
+            return value
+
+    def __str__(self):
+        return self.value
+# singleton
+ClientRequestId = ClientRequestId()
+
+
+class TokenBucket:
+    """
+        Local token-bucket limiter. Each request toward a host consumes a
+        token; tokens refill at `rate` per second up to `capacity`.
+
+    ARGUMENTS
+
+        rate -> float
+              tokens added per second.
+
+        capacity -> int
+              maximum burst size.
+    """
+    def __init__(self, rate: float = 0.5, capacity: int = 10):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = float(capacity)
+        self.stamp    = time.monotonic()
+        self.lock     = threading.Lock()
+
+    def acquire(self):
+        """ block until a token is available, then consume it. """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                        self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            debug(f'TokenBucket.acquire: waiting {wait:.2f}s\n')
+            time.sleep(wait)
+
+
+class FetchPolicy:
+    """
+        Tunables for o365ipAddr_get: per-host rate limits and the retry
+        schedule applied when upstream throttles (429) or fails (5xx).
+
+    ATTRIBUTES
+
+        rate, capacity -> float, int
+              token-bucket parameters used for each new host.
+
+        retries -> int
+              retry attempts after the first request.
+
+        backoff, backoffMax -> float
+              exponential backoff base and ceiling, in seconds. The actual
+              delay is drawn uniformly from [0, min(backoffMax, backoff*2**n)]
+              unless upstream sends a longer Retry-After; either way it never
+              exceeds backoffMax. A Retry-After beyond backoffMax stops
+              retrying: the last good snapshot is served, or the error raised.
+
+        timeout -> float
+              per-request timeout, in seconds.
+    """
+    rate:       float = 0.5
+    capacity:   int   = 10
+    retries:    int   = 4
+    backoff:    float = 1.0
+    backoffMax: float = 60.0
+    timeout:    float = 30.0
+    retryStatus       = frozenset((429, 500, 502, 503, 504))
+
+    _buckets = {}
+    _lock    = threading.Lock()
+
+    def bucket(self, URI):
+        host = urlparse(URI).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            return self._buckets[host]
+
+    def retryAfter(self, response):
+        """ seconds requested by a Retry-After header, or None. accepts both
+            the delta-seconds and HTTP-date forms.
+        """
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+    def delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoffMax, self.backoff * 2 ** attempt))
+        retryAfter = self.retryAfter(response)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        return min(delay, self.backoffMax)
+# singleton
+FetchPolicy = FetchPolicy()
+
+
+class Snapshot(O365BaseModel):
+    """
+        Last good response for a request, along with the validators needed
+        to revalidate it.
+
+    ATTRIBUTES
+
+        etag -> str
+        lastModified -> str
+        body -> str
+              raw response text; re-parsed on 304 or when upstream is down.
+    """
+    etag:         Optional[str]
+    lastModified: Optional[str]
+    body:         str
+
+
+class SnapshotStore:
+    """
+        Last good Snapshot per request, kept in memory and mirrored to disk
+        so that conditional requests and the outage fallback survive
+        restarts and are shared by instances running as the same user.
+
+        Snapshot bodies end up in the EDL, so unlike the ClientRequestId
+        they are kept out of the shared temp dir: `directory` is created
+        with mode 0700, and neither it nor the file is trusted unless it
+        is owned by the current user and not writable by anyone else.
+
+    ATTRIBUTES
+
+        directory -> pathlib.Path
+              state directory; $O365IPADDR_STATE or ~/.o365ipAddr.
+
+        path -> pathlib.Path
+              json file mapping request keys to snapshots.
+    """
+    directory: Path = Path(os.environ.get('O365IPADDR_STATE')
+                           or Path.home() / '.o365ipAddr')
+    _snapshots: Dict[str, Snapshot] = {}
+    _lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.directory / 'snapshots.json'
+
+    @staticmethod
+    def _trusted(st):
+        """ owned by us and not writable by group or others. """
+        if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+            return False
+        return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def _directory(self):
+        """ create `directory` if needed; None unless it is safe to use. """
+        try:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            st = os.lstat(self.directory)
+        except OSError as e:
+            debug(f'SnapshotStore: unable to create {self.directory}: {e}\n')
+            return None
+        if not stat.S_ISDIR(st.st_mode) or not self._trusted(st):
+            debug(f'SnapshotStore: refusing untrusted {self.directory}\n')
+            return None
+        return self.directory
+
+    def _read(self):
+        if self._directory() is None:
+            return {}
+        try:
+            fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError as e:
+            debug(f'SnapshotStore: unable to read {self.path}: {e}\n')
+            return {}
+        with open(fd) as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or not self._trusted(st):
+                debug(f'SnapshotStore: refusing untrusted {self.path}\n')
+                return {}
+            try:
+                stored = json.load(f)
+                return { key: Snapshot.parse_obj(value)
+                         for key, value in stored.items() }
+            except (OSError, ValueError, AttributeError) as e:
+                debug(f'SnapshotStore: unable to read {self.path}: {e}\n')
+                return {}
+
+    def get(self, key):
+        """ snapshot for `key`, falling back to disk on a miss. """
+        with self._lock:
+            if key not in self._snapshots:
+                for k, snapshot in self._read().items():
+                    self._snapshots.setdefault(k, snapshot)
+            return self._snapshots.get(key)
+
+    def put(self, key, snapshot):
+        """ record `snapshot` for `key` and rewrite the file. """
+        with self._lock:
+            # other instances may have written newer entries since we read
+            self._snapshots.update(self._read())
+            self._snapshots[key] = snapshot
+            stored = self._snapshots
+            if self._directory() is None:
+                return
+            # a private temp file per write, so concurrent instances never
+            # interleave; os.replace then swaps it in atomically.
+            try:
+                fd, tmp = tempfile.mkstemp(dir=self.directory,
+                        prefix='.snapshots.', suffix='.tmp')
+            except OSError as e:
+                debug(f'SnapshotStore: unable to persist {self.path}: {e}\n')
+                return
+            try:
+                with open(fd, 'w') as f:
+                    json.dump({ k: v.dict() for k, v in stored.items() }, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                debug(f'SnapshotStore: unable to persist {self.path}: {e}\n')
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    def clear(self):
+        """ drop in-memory snapshots; the file is left alone. """
+        with self._lock:
+            self._snapshots.clear()
+# singleton
+SnapshotStore = SnapshotStore()
+
+def o365ipAddr_fetch(URI: str, params: dict):
+    """
+        Conditional, rate limited GET against the o365 web service.
+
+        Sends If-None-Match/If-Modified-Since from the last good response
+        (see SnapshotStore), returning the stored body on 304. 429 and 5xx responses are retried
+        with exponential backoff and jitter. When retries are exhausted or
+        the host is unreachable, the last good body is served instead; with
+        no snapshot to fall back on the error is raised.
+
+    ARGUMENTS
+
+        URI
+              request uri
+
+        params
+              query parameters, excluding ClientRequestId.
+
+    RETURNS
+
+        str   # response body
+    """
+    key = '%s?%s' % (URI, uu(sorted(params.items())))
+    snapshot = SnapshotStore.get(key)
+    headers = {}
+    if snapshot is not None:
+        if snapshot.etag:
+            headers['If-None-Match'] = snapshot.etag
+        if snapshot.lastModified:
+            headers['If-Modified-Since'] = snapshot.lastModified
+    params = dict(params, ClientRequestId=ClientRequestId.value)
+    bucket = FetchPolicy.bucket(URI)
+
+    attempt = 0
+    while True:
+        bucket.acquire()
+        debug("o365ipAddr_fetch: GET %s?%s HTTP/1.1\n" % (URI, uu(params)))
+        try:
+            response = requests.get(URI, params=params, headers=headers,
+                    timeout=FetchPolicy.timeout)
+        except requests.RequestException as e:
+            response, error = None, e
+        else:
+            error = None
+            if response.status_code == 304 and snapshot is not None:
+                debug('o365ipAddr_fetch: 304 Not Modified\n')
+                # a 304 may carry updated validators (RFC 9111 4.3.4)
+                etag         = response.headers.get('ETag') or snapshot.etag
+                lastModified = (response.headers.get('Last-Modified')
+                                or snapshot.lastModified)
+                if (etag, lastModified) != (snapshot.etag, snapshot.lastModified):
+                    SnapshotStore.put(key, Snapshot(
+                        etag         = etag,
+                        lastModified = lastModified,
+                        body         = snapshot.body))
+                return snapshot.body
+            if response.status_code == 304:
+                # no snapshot to revalidate against; nothing usable came back
+                raise requests.HTTPError(
+                    '304 Not Modified without a stored snapshot for %s' % URI,
+                    response=response)
+            if 200 <= response.status_code < 300:
+                SnapshotStore.put(key, Snapshot(
+                    etag         = response.headers.get('ETag'),
+                    lastModified = response.headers.get('Last-Modified'),
+                    body         = response.text))
+                return response.text
+            if response.status_code not in FetchPolicy.retryStatus:
+                response.raise_for_status()
+        if attempt >= FetchPolicy.retries:
+            break
+        retryAfter = FetchPolicy.retryAfter(response)
+        if retryAfter is not None and retryAfter > FetchPolicy.backoffMax:
+            debug('o365ipAddr_fetch: Retry-After %.0fs exceeds backoffMax\n'
+                    % retryAfter)
+            break
+        delay = FetchPolicy.delay(attempt, response)
+        debug('o365ipAddr_fetch: retry %d in %.2fs (%s)\n'
+                % (attempt + 1, delay, error or response.status_code))
+        time.sleep(delay)
+        attempt += 1
+
+    if snapshot is not None:
+        debug('o365ipAddr_fetch: upstream unavailable, serving last snapshot\n')
+        return snapshot.body
+    if error is not None:
+        raise error
+    response.raise_for_status()
+
+
+
 ##### Implementation ########################################
 
 def o365ipAddr_json(Model, json):
@@ -376,26 +756,21 @@ def o365ipAddr_get(
         Format: FormatParam = FormatParam.JSON,
         **options):
     params = {} 
-    params['ClientRequestId'] = str(uuid4())
     params['Format']          = Format.value
     for key in options.keys():
         if options[key] is not None:
             params[key] = options[key]
-    debug("o365ipAddr_get: GET %s?%s HTTP/1.1\n" % (URI, uu(params)))
-    response = requests.get(URI, params=params)
-    if response.ok:
-        if Format == FormatParam.JSON:
-            # JSON Response (hopefully)... 
-            ModelCount, Models = o365ipAddr_json(Model, response.json())
-        else:
-            # Asked for other arbitrary data (CSV)
-            debug('o365ipAddr_get.text: %s\n' % (response.text))
-            ModelCount, TextData = None, response.text
-        debug("o365ipAddr_get.return(ModelCount, Models) -> %s,\n%s\n\n" 
-                % (ModelCount, pformat(Models)))
-        return ModelCount, Models
+    body = o365ipAddr_fetch(URI, params)
+    if Format == FormatParam.JSON:
+        # JSON Response (hopefully)... 
+        ModelCount, Models = o365ipAddr_json(Model, json.loads(body))
     else:
-        response.raise_for_status()
+        # Asked for other arbitrary data (CSV)
+        debug('o365ipAddr_get.text: %s\n' % (body))
+        ModelCount, Models = None, body
+    debug("o365ipAddr_get.return(ModelCount, Models) -> %s,\n%s\n\n" 
+            % (ModelCount, pformat(Models)))
+    return ModelCount, Models
 
 def getVersion(
         AllVersions:   bool             = False,
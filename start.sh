@@ -14,7 +14,7 @@ if [ ! -d "$VENVROOT" ] ; then
   # activate virtual environment
   . $VENVROOT/bin/activate
   # install packages in freeze
-  pip install flask requests-cache
+  pip install flask requests
 fi
 
 
@@ -0,0 +1,191 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+import requests
+import o365ipAddr
+
+
+URI = 'https://endpoints.office.com/version'
+PARAMS = {'Format': 'CSV', 'Instance': 'Worldwide'}
+
+
+def response(status_code, text='', headers=None):
+    """ minimal stand-in for requests.models.Response """
+    mock = MagicMock()
+    mock.status_code = status_code
+    mock.text        = text
+    mock.headers     = headers or {}
+    def raise_for_status():
+        if status_code >= 400:
+            raise requests.HTTPError(f'{status_code} Error', response=mock)
+    mock.raise_for_status.side_effect = raise_for_status
+    return mock
+
+
+class testFetch(unittest.TestCase):
+    """
+    Unittests for o365ipAddr.o365ipAddr_fetch and its supporting classes
+    """
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        for target, attribute, value in (
+                (o365ipAddr.ClientRequestId, 'path',  self.tmp / 'clientid.txt'),
+                (o365ipAddr.ClientRequestId, '_value', None),
+                (o365ipAddr.SnapshotStore,   'directory', self.tmp / 'state'),
+                (o365ipAddr.FetchPolicy,     '_buckets', {}),
+                (o365ipAddr.FetchPolicy,     'capacity', 100)):
+            patch.object(target, attribute, value).start()
+        self.sleep = patch.object(o365ipAddr.time, 'sleep').start()
+        self.addCleanup(patch.stopall)
+        o365ipAddr.SnapshotStore.clear()
+        self.addCleanup(o365ipAddr.SnapshotStore.clear)
+
+    def fetch(self, *responses):
+        """ run o365ipAddr_fetch against a queue of canned responses """
+        get = MagicMock(side_effect=list(responses))
+        with patch.object(o365ipAddr.requests, 'get', get):
+            return o365ipAddr.o365ipAddr_fetch(URI, dict(PARAMS)), get
+
+    def test_not_modified(self):
+        """ 200 then 304 reuses the stored body and sends If-None-Match """
+        body, _ = self.fetch(response(200, 'v1', {'ETag': '"a"'}))
+        self.assertEqual(body, 'v1')
+        body, get = self.fetch(response(304))
+        self.assertEqual(body, 'v1')
+        self.assertEqual(get.call_args.kwargs['headers'], {'If-None-Match': '"a"'})
+
+    def test_not_modified_updates_validators(self):
+        """ validators on a 304 replace the stored ones """
+        self.fetch(response(200, 'v1', {'ETag': '"a"'}))
+        self.fetch(response(304, headers={'ETag': '"b"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        o365ipAddr.SnapshotStore.clear()
+        body, get = self.fetch(response(304))
+        self.assertEqual(body, 'v1')
+        self.assertEqual(get.call_args.kwargs['headers'], {
+            'If-None-Match': '"b"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+
+    def test_not_modified_without_snapshot(self):
+        """ 304 with nothing to revalidate raises and stores nothing """
+        with self.assertRaises(requests.HTTPError):
+            self.fetch(response(304))
+        self.assertFalse(o365ipAddr.SnapshotStore.path.exists())
+
+    def test_unavailable_serves_snapshot(self):
+        """ 503 until retries run out falls back to the snapshot """
+        self.fetch(response(200, 'v1'))
+        retries = o365ipAddr.FetchPolicy.retries
+        body, get = self.fetch(*[response(503)] * (retries + 1))
+        self.assertEqual(body, 'v1')
+        self.assertEqual(get.call_count, retries + 1)
+
+    def test_throttled_without_snapshot(self):
+        """ 429 with no snapshot raises HTTPError """
+        retries = o365ipAddr.FetchPolicy.retries
+        with self.assertRaises(requests.HTTPError):
+            self.fetch(*[response(429)] * (retries + 1))
+
+    def test_connection_error(self):
+        """ ConnectionError is re-raised when there is no snapshot """
+        retries = o365ipAddr.FetchPolicy.retries
+        with self.assertRaises(requests.ConnectionError):
+            self.fetch(*[requests.ConnectionError()] * (retries + 1))
+
+    def test_retry_after_capped(self):
+        """ Retry-After never delays past backoffMax """
+        policy = o365ipAddr.FetchPolicy
+        self.assertEqual(policy.delay(0, response(429, headers={'Retry-After': '3600'})),
+                         policy.backoffMax)
+        self.assertEqual(policy.retryAfter(response(429, headers={
+            'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0.0)
+
+    def test_retry_after_serves_snapshot(self):
+        """ Retry-After beyond backoffMax serves the snapshot without waiting """
+        self.fetch(response(200, 'v1'))
+        body, get = self.fetch(response(429, headers={'Retry-After': '3600'}))
+        self.assertEqual(body, 'v1')
+        self.assertEqual(get.call_count, 1)
+        self.sleep.assert_not_called()
+
+    def test_retry_after_without_snapshot(self):
+        """ Retry-After beyond backoffMax raises at once with no snapshot """
+        get = MagicMock(return_value=response(429, headers={'Retry-After': '3600'}))
+        with patch.object(o365ipAddr.requests, 'get', get), \
+             self.assertRaises(requests.HTTPError):
+            o365ipAddr.o365ipAddr_fetch(URI, dict(PARAMS))
+        self.assertEqual(get.call_count, 1)
+        self.sleep.assert_not_called()
+
+    def test_snapshot_survives_restart(self):
+        """ a fresh process picks up validators and body from disk """
+        self.fetch(response(200, 'v1', {'ETag': '"a"'}))
+        o365ipAddr.SnapshotStore.clear()
+        body, get = self.fetch(response(304))
+        self.assertEqual(body, 'v1')
+        self.assertEqual(get.call_args.kwargs['headers'], {'If-None-Match': '"a"'})
+
+    def test_snapshot_directory_private(self):
+        """ the state directory is created 0700 """
+        self.fetch(response(200, 'v1'))
+        mode = o365ipAddr.SnapshotStore.directory.stat().st_mode
+        self.assertEqual(mode & 0o777, 0o700)
+
+    def test_snapshot_write_leaves_no_temp_files(self):
+        """ each write goes through its own temp file, replaced into place """
+        with patch.object(o365ipAddr.tempfile, 'mkstemp',
+                wraps=o365ipAddr.tempfile.mkstemp) as mkstemp:
+            self.fetch(response(200, 'v1'))
+        mkstemp.assert_called_once()
+        self.assertEqual([p.name for p in
+            o365ipAddr.SnapshotStore.directory.iterdir()], ['snapshots.json'])
+
+    def test_untrusted_snapshot_ignored(self):
+        """ a snapshot file writable by others, or a symlink, is not loaded """
+        self.fetch(response(200, 'v1', {'ETag': '"a"'}))
+        path = o365ipAddr.SnapshotStore.path
+        path.chmod(0o666)
+        o365ipAddr.SnapshotStore.clear()
+        self.assertIsNone(o365ipAddr.SnapshotStore.get(next(iter(
+            json.loads(path.read_text())))))
+        path.chmod(0o600)
+        planted = self.tmp / 'planted.json'
+        path.rename(planted)
+        path.symlink_to(planted)
+        self.assertEqual(o365ipAddr.SnapshotStore._read(), {})
+
+    def test_client_request_id_persisted(self):
+        """ ClientRequestId is generated once and reloaded from disk """
+        value = o365ipAddr.ClientRequestId.value
+        o365ipAddr.ClientRequestId._value = None
+        self.assertEqual(o365ipAddr.ClientRequestId.value, value)
+        _, get = self.fetch(response(200, 'v1'))
+        self.assertEqual(get.call_args.kwargs['params']['ClientRequestId'], value)
+
+
+class testTokenBucket(unittest.TestCase):
+    """
+    Unittests for o365ipAddr.TokenBucket
+    """
+    def test_blocks_when_empty(self):
+        """ acquire sleeps for the refill time once capacity is spent """
+        clock = [0.0]
+        def sleep(seconds):
+            clock[0] += seconds
+        with patch.object(o365ipAddr.time, 'monotonic', lambda: clock[0]), \
+             patch.object(o365ipAddr.time, 'sleep', side_effect=sleep) as mock:
+            bucket = o365ipAddr.TokenBucket(rate=0.5, capacity=2)
+            bucket.acquire()
+            bucket.acquire()
+            mock.assert_not_called()
+            bucket.acquire()
+            mock.assert_called_once_with(2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()